@@ -3,12 +3,13 @@ TinyGuardian FastAPI Application
 Web API and dashboard for monitoring.
 """
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Query
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
+from loguru import logger
 import uvicorn
 import sys
 import os
@@ -16,38 +17,42 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from tinyguardian.core.guardian import TinyGuardian
-from tinyguardian.core.threat_classifier import SecurityEvent
 
-app = FastAPI(title="TinyGuardian API", version="0.1.0")
-
-# Initialize guardian (will be started separately)
+# Initialize guardian (started with the app, on the server's event loop)
 guardian_instance: Optional[TinyGuardian] = None
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start and stop guardian monitoring alongside the server."""
+    if guardian_instance:
+        try:
+            await guardian_instance.start_monitoring()
+        except Exception as e:
+            logger.error(f"Failed to start monitoring: {e}")
+            raise
+    yield
+    if guardian_instance:
+        logger.info("Shutting down...")
+        await guardian_instance.stop_monitoring()
+
+
+app = FastAPI(
+    title="TinyGuardian API",
+    version="0.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
+
+
 def set_guardian(guardian: TinyGuardian):
     """Set the guardian instance."""
     global guardian_instance
     guardian_instance = guardian
 
 
-class EventResponse(BaseModel):
-    """Event response model."""
-    event_id: str
-    device_id: str
-    timestamp: str
-    threat_level: str
-    severity: float
-    threat_type: str
-    explanation: str
-    recommendation: str
-    source_ip: Optional[str] = None
-    user: Optional[str] = None
-
-
-@app.get("/")
-async def root():
-    """Root endpoint - serve dashboard."""
-    html = """
+# Dashboard page, encoded once at import and served as-is
+_DASHBOARD_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -120,49 +125,37 @@ async def root():
     </body>
     </html>
     """
-    return HTMLResponse(content=html)
+_DASHBOARD_BYTES = _DASHBOARD_HTML.encode("utf-8")
+
+
+@app.get("/")
+async def root():
+    """Root endpoint - serve dashboard."""
+    return Response(content=_DASHBOARD_BYTES, media_type="text/html")
+
+
+# API handlers stay `async def`: they only read the guardian's in-memory
+# buffers, which the processing task mutates on this same event loop, and
+# the page size is capped so each request does bounded work on the loop.
+MAX_PAGE_SIZE = 1000
 
 
 @app.get("/api/v1/alerts")
-async def get_alerts(limit: int = 50):
+async def get_alerts(limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
     """Get recent alerts."""
     if not guardian_instance:
-        return []
+        return ORJSONResponse([])
     
-    alerts = guardian_instance.get_alerts(limit=limit)
-    return [EventResponse(
-        event_id=e.event_id,
-        device_id=e.device_id,
-        timestamp=e.timestamp.isoformat(),
-        threat_level=e.threat_level,
-        severity=e.severity,
-        threat_type=e.threat_type.value,
-        explanation=e.explanation,
-        recommendation=e.recommendation,
-        source_ip=e.source_ip,
-        user=e.user
-    ).dict() for e in alerts]
+    return ORJSONResponse(guardian_instance.get_alerts(limit=limit))
 
 
 @app.get("/api/v1/events")
-async def get_events(limit: int = 100):
+async def get_events(limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
     """Get recent events."""
     if not guardian_instance:
-        return []
+        return ORJSONResponse([])
     
-    events = guardian_instance.get_recent_events(limit=limit)
-    return [EventResponse(
-        event_id=e.event_id,
-        device_id=e.device_id,
-        timestamp=e.timestamp.isoformat(),
-        threat_level=e.threat_level,
-        severity=e.severity,
-        threat_type=e.threat_type.value,
-        explanation=e.explanation,
-        recommendation=e.recommendation,
-        source_ip=e.source_ip,
-        user=e.user
-    ).dict() for e in events]
+    return ORJSONResponse(guardian_instance.get_recent_events(limit=limit))
 
 
 @app.get("/api/v1/stats")
@@ -171,7 +164,16 @@ async def get_stats():
     if not guardian_instance:
         return {"total_events": 0, "alerts": 0, "threat_types": {}}
     
-    return guardian_instance.get_stats()
+    return Response(content=guardian_instance.get_stats_json(), media_type="application/json")
+
+
+@app.get("/api/v1/debug/llm-cache")
+async def get_llm_cache_info():
+    """Get LLM response cache statistics."""
+    if not guardian_instance:
+        return {}
+    
+    return guardian_instance.llm_client.cache_info()._asdict()
 
 
 @app.get("/health")
@@ -181,7 +183,7 @@ async def health():
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    uvicorn.run(app, host="0.0.0.0", port=8080, loop="uvloop", http="httptools")
 
 
 
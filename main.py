@@ -6,13 +6,11 @@ import argparse
 import yaml
 from pathlib import Path
 from loguru import logger
-import signal
 import sys
 
 from tinyguardian.core.guardian import TinyGuardian
 from api.main import app, set_guardian
 import uvicorn
-import threading
 
 
 def load_config(config_path: str = "config/config.yaml") -> dict:
@@ -35,15 +33,23 @@ def main():
     # Load config
     config = load_config(args.config)
     
-    # Initialize guardian
+    # Initialize guardian (tuning keys are optional, so older configs still load)
+    storage_config = config.get("storage", {})
     guardian = TinyGuardian(
         mqtt_broker=config["mqtt"]["broker"],
         mqtt_port=config["mqtt"]["port"],
         mqtt_topics=config["mqtt"]["topics"],
+        batched_payloads=config["mqtt"].get("batched_payloads", False),
+        max_payload_lines=config["mqtt"].get("max_payload_lines", 100),
         llm_provider=config["llm"]["provider"],
         llm_model=config["llm"]["model"],
         llm_base_url=config["llm"]["base_url"],
-        severity_threshold=config["threat_detection"]["severity_threshold"]
+        llm_batch_size=config["llm"].get("batch_size", 8),
+        llm_max_concurrency=config["llm"].get("max_concurrency", 4),
+        severity_threshold=config["threat_detection"]["severity_threshold"],
+        max_events=storage_config.get("max_events", 10000),
+        max_alerts=storage_config.get("max_alerts", 1000),
+        stats_cache_ttl=config["server"].get("stats_cache_ttl", 1.0)
     )
     
     # Set guardian for API
@@ -58,44 +64,19 @@ def main():
     
     guardian.register_alert_callback(on_alert)
     
-    # Start monitoring
-    try:
-        guardian.start_monitoring()
-    except Exception as e:
-        logger.error(f"Failed to start monitoring: {e}")
-        sys.exit(1)
-    
-    # Start web server in background
+    # Run the web server in the foreground. Monitoring starts and stops with
+    # the app (see api.main.lifespan) and shares uvicorn's event loop, and
+    # uvicorn handles SIGINT/SIGTERM for a graceful shutdown.
     server_config = config["server"]
-    server_thread = threading.Thread(
-        target=lambda: uvicorn.run(
-            app,
-            host=server_config["host"],
-            port=server_config["port"],
-            log_level=server_config["log_level"].lower()
-        ),
-        daemon=True
+    logger.info(f"Starting TinyGuardian. Dashboard: http://{server_config['host']}:{server_config['port']}")
+    uvicorn.run(
+        app,
+        host=server_config["host"],
+        port=server_config["port"],
+        log_level=server_config["log_level"].lower(),
+        loop="uvloop",
+        http="httptools"
     )
-    server_thread.start()
-    
-    logger.info(f"TinyGuardian started. Dashboard: http://{server_config['host']}:{server_config['port']}")
-    
-    # Handle shutdown
-    def signal_handler(sig, frame):
-        logger.info("Shutting down...")
-        guardian.stop_monitoring()
-        sys.exit(0)
-    
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
-    # Keep running
-    try:
-        while True:
-            import time
-            time.sleep(1)
-    except KeyboardInterrupt:
-        signal_handler(None, None)
 
 
 if __name__ == "__main__":
@@ -3,12 +3,13 @@ Simulate IoT device logs for testing.
 """
 
 import paho.mqtt.client as mqtt
+import json
 import time
 import random
 from datetime import datetime
 
 
-def simulate_logs(broker="localhost", port=1883, interval=2):
+def simulate_logs(broker="localhost", port=1883, interval=2, rate=None, batch=1):
     """Simulate IoT device logs via MQTT."""
     client = mqtt.Client(client_id="iot_simulator")
     
@@ -35,6 +36,10 @@ def simulate_logs(broker="localhost", port=1883, interval=2):
         client.connect(broker, port, 60)
         print(f"Connected to MQTT broker {broker}:{port}")
         
+        if rate is not None:
+            _stress(client, devices, normal_logs, suspicious_logs, rate, batch)
+            return
+        
         while True:
             device = random.choice(devices)
             
@@ -57,15 +62,63 @@ def simulate_logs(broker="localhost", port=1883, interval=2):
         print(f"Error: {e}")
 
 
+def _stress(client, devices, normal_logs, suspicious_logs, rate, batch):
+    """
+    Publish pre-encoded logs as fast as possible (rate <= 0) or at `rate` logs/s.
+    
+    With batch > 1, each publish carries `batch` log lines as a JSON array.
+    Messages are QoS 0, fire-and-forget, and carry no timestamp prefix; the
+    guardian stamps them on receipt.
+    """
+    topics = [f"iot/devices/{device}/logs" for device in devices]
+    
+    # Same 80/20 normal/suspicious mix as the interval mode
+    def pick_log():
+        return random.choice(suspicious_logs if random.random() < 0.2 else normal_logs)
+    
+    if batch > 1:
+        payloads = [json.dumps([pick_log() for _ in range(batch)]).encode() for _ in range(256)]
+    else:
+        payloads = [log.encode() for log in normal_logs * 4 + suspicious_logs]
+    
+    publish_interval = batch / rate if rate > 0 else 0.0
+    client.loop_start()
+    
+    sent = 0
+    next_publish = time.perf_counter()
+    next_report = time.monotonic() + 1.0
+    try:
+        while True:
+            client.publish(random.choice(topics), random.choice(payloads), qos=0)
+            sent += batch
+            
+            if publish_interval:
+                next_publish += publish_interval
+                delay = next_publish - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            
+            if time.monotonic() >= next_report:
+                print(f"Published {sent} logs/s")
+                sent = 0
+                next_report += 1.0
+    finally:
+        client.loop_stop()
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Simulate IoT device logs")
     parser.add_argument("--broker", default="localhost", help="MQTT broker")
     parser.add_argument("--port", type=int, default=1883, help="MQTT port")
     parser.add_argument("--interval", type=int, default=2, help="Log interval (seconds)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Stress mode: logs per second (0 = unthrottled)")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="Stress mode: log lines per MQTT message (JSON array)")
     
     args = parser.parse_args()
-    simulate_logs(args.broker, args.port, args.interval)
+    simulate_logs(args.broker, args.port, args.interval, args.rate, args.batch)
 
 
 
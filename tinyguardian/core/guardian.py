@@ -4,17 +4,23 @@ Orchestrates IoT monitoring, LLM analysis, and threat detection.
 """
 
 import paho.mqtt.client as mqtt
-from typing import Dict, Optional, Callable
+from typing import Dict, List, Optional, Callable, Tuple
 from datetime import datetime
+from collections import Counter, deque
+from itertools import islice
+import asyncio
 import json
 import re
+import time
+import orjson
 from loguru import logger
-import threading
-import queue
 
-from .llm_client import LLMClient
+from .llm_client import LLMClient, strip_timestamp_prefix
 from .threat_classifier import ThreatClassifier, SecurityEvent
 
+# Device ID segment of an MQTT topic, wherever "devices/<id>" appears in it
+_DEVICE_RE = re.compile(r'devices/([^/]+)')
+
 
 class TinyGuardian:
     """
@@ -25,10 +31,17 @@ class TinyGuardian:
                  mqtt_broker: str = "localhost",
                  mqtt_port: int = 1883,
                  mqtt_topics: list = None,
+                 batched_payloads: bool = False,
+                 max_payload_lines: int = 100,
                  llm_provider: str = "ollama",
                  llm_model: str = "phi3:mini",
                  llm_base_url: str = "http://localhost:11434",
-                 severity_threshold: float = 0.7):
+                 llm_batch_size: int = 8,
+                 llm_max_concurrency: int = 4,
+                 severity_threshold: float = 0.7,
+                 max_events: int = 10000,
+                 max_alerts: int = 1000,
+                 stats_cache_ttl: float = 1.0):
         """
         Initialize TinyGuardian.
         
@@ -36,20 +49,30 @@ class TinyGuardian:
             mqtt_broker: MQTT broker hostname
             mqtt_port: MQTT broker port
             mqtt_topics: List of MQTT topics to subscribe to
+            batched_payloads: Split JSON-array payloads into one log line per element
+            max_payload_lines: Largest array split; bigger ones stay a single log line
             llm_provider: LLM provider name
             llm_model: LLM model name
             llm_base_url: LLM API base URL
+            llm_batch_size: Maximum queued logs analyzed per batch
+            llm_max_concurrency: Maximum concurrent LLM requests
             severity_threshold: Minimum severity for alerts
+            max_events: Number of recent events kept in memory
+            max_alerts: Number of recent alerts kept in memory
+            stats_cache_ttl: Seconds a serialized stats payload is reused
         """
         self.mqtt_broker = mqtt_broker
         self.mqtt_port = mqtt_port
         self.mqtt_topics = mqtt_topics or ["iot/devices/+/logs"]
+        self.batched_payloads = batched_payloads
+        self.max_payload_lines = max_payload_lines
         
         # Initialize components
         self.llm_client = LLMClient(
             provider=llm_provider,
             model=llm_model,
-            base_url=llm_base_url
+            base_url=llm_base_url,
+            max_concurrency=llm_max_concurrency
         )
         self.classifier = ThreatClassifier(severity_threshold=severity_threshold)
         
@@ -57,24 +80,49 @@ class TinyGuardian:
         self.mqtt_client = None
         self.running = False
         
-        # Event storage
-        self.events: list = []
+        # Event storage: bounded ring buffers of pre-serialized dicts, newest last.
+        # Only touched from the event loop, which the API handlers share; the MQTT
+        # thread hands messages over via call_soon_threadsafe. Reading them from
+        # another thread would need a lock: iterating a deque while it is
+        # appended to raises RuntimeError.
+        self._events: deque = deque(maxlen=max_events)
+        self._alerts: deque = deque(maxlen=max_alerts)
+        self._threat_type_counts: Counter = Counter()
+        self._total_events = 0
+        self._alerts_count = 0
+        self._start_time = datetime.now()
+        self._stats_cache_ttl = stats_cache_ttl
+        self._stats_cache: Optional[Tuple[float, bytes]] = None  # (monotonic time, JSON)
         self.alert_callbacks: list = []
         
-        # Processing queue
-        self.processing_queue = queue.Queue()
-        self.processing_thread = None
+        # Processing queue, fed from the MQTT network thread and drained by a
+        # task on the event loop (created in start_monitoring)
+        self.processing_queue: Optional[asyncio.Queue] = None
+        self.llm_batch_size = llm_batch_size
+        self._processing_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # Fast pre-classifier: logs that are, in their entirety (after the
+        # timestamp prefix), a known routine message skip the LLM round-trip.
+        # Anything appended to a routine phrase still goes to the LLM.
+        self._normal_re = re.compile(
+            r"(?:device started(?: successfully)?"
+            r"|temperature reading: -?\d+(?:\.\d+)?\s*°?[fc]?"
+            r"|door (?:locked|unlocked)"
+            r"|scheduled check-in(?: completed)?)\.?\s*",
+            re.IGNORECASE
+        )
         
         logger.info("TinyGuardian initialized")
     
-    def start_monitoring(self):
-        """Start monitoring IoT devices."""
+    async def start_monitoring(self):
+        """Start monitoring IoT devices on the running event loop."""
         if self.running:
             logger.warning("Already monitoring")
             return
         
         # Test LLM connection
-        if not self.llm_client.test_connection():
+        if not await self.llm_client.test_connection():
             logger.error("Failed to connect to LLM provider")
             raise ConnectionError("LLM provider not available")
         
@@ -89,22 +137,31 @@ class TinyGuardian:
             logger.error(f"Failed to connect to MQTT broker: {e}")
             raise
         
-        # Start processing thread
-        self.processing_thread = threading.Thread(target=self._process_queue, daemon=True)
-        self.processing_thread.start()
+        # Start processing task
+        self._loop = asyncio.get_running_loop()
+        self.processing_queue = asyncio.Queue()
+        self.running = True
+        self._processing_task = asyncio.create_task(self._process_queue())
         
         # Start MQTT loop
-        self.running = True
         self.mqtt_client.loop_start()
         
         logger.info("Started monitoring IoT devices")
     
-    def stop_monitoring(self):
+    async def stop_monitoring(self):
         """Stop monitoring."""
         self.running = False
         if self.mqtt_client:
             self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
+        if self._processing_task:
+            self._processing_task.cancel()
+            try:
+                await self._processing_task
+            except asyncio.CancelledError:
+                pass
+            self._processing_task = None
+        await self.llm_client.aclose()
         logger.info("Stopped monitoring")
     
     def _on_mqtt_connect(self, client, userdata, flags, rc):
@@ -119,47 +176,88 @@ class TinyGuardian:
             logger.error(f"Failed to connect to MQTT broker: {rc}")
     
     def _on_mqtt_message(self, client, userdata, msg):
-        """Callback for MQTT messages."""
+        """Callback for MQTT messages (runs on the MQTT network thread)."""
         try:
-            payload = msg.payload.decode('utf-8')
             topic = msg.topic
             
             # Extract device ID from topic (e.g., iot/devices/device_01/logs -> device_01)
-            device_match = re.search(r'devices/([^/]+)', topic)
+            device_match = _DEVICE_RE.search(topic)
             device_id = device_match.group(1) if device_match else "unknown"
             
-            # Add to processing queue
-            self.processing_queue.put({
+            # Hand the raw payload to the event loop; decoding happens there so
+            # this thread goes straight back to reading from the broker
+            self._loop.call_soon_threadsafe(
+                self._enqueue, device_id, topic, msg.payload, datetime.now()
+            )
+        except Exception as e:
+            logger.error(f"Error processing MQTT message: {e}")
+    
+    def _split_payload(self, payload: str) -> list:
+        """
+        Split a batched payload (JSON array of log lines) into single log lines.
+        
+        Only done when batched_payloads is enabled, and only for arrays of at
+        most max_payload_lines strings; anything else is one log line.
+        """
+        if self.batched_payloads and payload.startswith('["'):
+            try:
+                log_messages = orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                return [payload]
+            if (len(log_messages) <= self.max_payload_lines
+                    and all(isinstance(log_message, str) for log_message in log_messages)):
+                return log_messages
+        return [payload]
+    
+    def _enqueue(self, device_id: str, topic: str, payload: bytes, timestamp: datetime):
+        """Decode an MQTT payload and queue its log lines (runs on the event loop)."""
+        for log_message in self._split_payload(payload.decode('utf-8', errors='replace')):
+            self.processing_queue.put_nowait({
                 "device_id": device_id,
-                "log_message": payload,
+                "log_message": log_message,
                 "topic": topic,
-                "timestamp": datetime.now()
+                "timestamp": timestamp
             })
-        except Exception as e:
-            logger.error(f"Error processing MQTT message: {e}")
     
-    def _process_queue(self):
-        """Process log messages from queue."""
+    async def _process_queue(self):
+        """Process log messages from queue, draining up to a batch at a time."""
         while self.running:
+            batch = [await self.processing_queue.get()]
+            while len(batch) < self.llm_batch_size:
+                try:
+                    batch.append(self.processing_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self._process_batch(batch)
+            except Exception as e:
+                logger.error(f"Error processing queue batch: {e}")
+    
+    async def _process_batch(self, items: list):
+        """Analyze a batch of log messages concurrently, then classify in order."""
+        canned = [self._prefilter(item["log_message"]) for item in items]
+        pending = [i for i, analysis in enumerate(canned) if analysis is None]
+        results = iter(await self.llm_client.analyze_batch(
+            [(items[i]["log_message"], items[i]["device_id"]) for i in pending]
+        ) if pending else ())
+        analyses: List[Dict] = [
+            analysis if analysis is not None else next(results) for analysis in canned
+        ]
+        
+        for item, llm_analysis in zip(items, analyses):
             try:
-                item = self.processing_queue.get(timeout=1)
-                self._process_log(item)
-            except queue.Empty:
-                continue
+                self._process_log(item, llm_analysis)
             except Exception as e:
                 logger.error(f"Error processing queue item: {e}")
     
-    def _process_log(self, item: Dict):
-        """Process a single log message."""
+    def _process_log(self, item: Dict, llm_analysis: Dict):
+        """Classify and store a single log message, given its analysis."""
         device_id = item["device_id"]
         log_message = item["log_message"]
         timestamp = item["timestamp"]
         
         logger.debug(f"Processing log from {device_id}: {log_message[:100]}")
         
-        # Analyze with LLM
-        llm_analysis = self.llm_client.analyze_log(log_message, device_id)
-        
         # Classify threat
         event = self.classifier.classify(
             device_id=device_id,
@@ -169,13 +267,29 @@ class TinyGuardian:
         )
         
         # Store event
-        self.events.append(event)
+        event_dict = event.to_dict()
+        self._events.append(event_dict)
+        self._threat_type_counts[event.threat_type_str] += 1
+        self._total_events += 1
         
         # Check if alert needed
         if self.classifier.is_alert(event):
-            logger.warning(f"🚨 ALERT: {event.threat_type.value} on {device_id} (severity: {event.severity:.2f})")
+            self._alerts.append(event_dict)
+            self._alerts_count += 1
+            logger.warning(f"🚨 ALERT: {event.threat_type_str} on {device_id} (severity: {event.severity:.2f})")
             self._trigger_alert(event)
     
+    def _prefilter(self, log_message: str) -> Optional[Dict]:
+        """Return a canned analysis for routine logs, or None if the LLM is needed."""
+        if self._normal_re.fullmatch(strip_timestamp_prefix(log_message)):
+            return {
+                "threat_level": "none",
+                "severity": 0.0,
+                "explanation": "Routine device activity",
+                "recommendation": "No action required"
+            }
+        return None
+    
     def _trigger_alert(self, event: SecurityEvent):
         """Trigger alert callbacks."""
         for callback in self.alert_callbacks:
@@ -189,30 +303,30 @@ class TinyGuardian:
         self.alert_callbacks.append(callback)
     
     def get_recent_events(self, limit: int = 100) -> list:
-        """Get recent security events."""
-        return sorted(self.events, key=lambda e: e.timestamp, reverse=True)[:limit]
+        """Get recent security events (newest first) as serialized dicts."""
+        return list(islice(reversed(self._events), limit))
     
     def get_alerts(self, limit: int = 50) -> list:
-        """Get recent alerts (high severity events)."""
-        alerts = [e for e in self.events if self.classifier.is_alert(e)]
-        return sorted(alerts, key=lambda e: e.timestamp, reverse=True)[:limit]
+        """Get recent alerts (high severity events) as serialized dicts."""
+        return list(islice(reversed(self._alerts), limit))
     
     def get_stats(self) -> Dict:
-        """Get statistics."""
-        total_events = len(self.events)
-        alerts = len([e for e in self.events if self.classifier.is_alert(e)])
-        
-        threat_types = {}
-        for event in self.events:
-            threat_type = event.threat_type.value
-            threat_types[threat_type] = threat_types.get(threat_type, 0) + 1
-        
+        """Get statistics from running counters (O(1), no history scan)."""
         return {
-            "total_events": total_events,
-            "alerts": alerts,
-            "threat_types": threat_types,
-            "uptime_seconds": (datetime.now() - self.events[0].timestamp).total_seconds() if self.events else 0
+            "total_events": self._total_events,
+            "alerts": self._alerts_count,
+            "threat_types": dict(self._threat_type_counts),
+            "uptime_seconds": (datetime.now() - self._start_time).total_seconds()
         }
+    
+    def get_stats_json(self) -> bytes:
+        """Get statistics as JSON bytes, reused for stats_cache_ttl seconds."""
+        now = time.monotonic()
+        if self._stats_cache is not None and now - self._stats_cache[0] < self._stats_cache_ttl:
+            return self._stats_cache[1]
+        payload = orjson.dumps(self.get_stats())
+        self._stats_cache = (now, payload)
+        return payload
 
 
 
@@ -3,11 +3,26 @@ LLM Client
 Handles communication with local LLM providers (Ollama, LM Studio, llama.cpp).
 """
 
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from enum import Enum
-import requests
+from collections import OrderedDict, namedtuple
+import asyncio
+import re
+import httpx
 from loguru import logger
-import json
+import orjson
+
+
+# Leading "[2024-01-01T12:00:00] " style timestamp prefix on device logs
+_TIMESTAMP_PREFIX_RE = re.compile(r'^\[[^\]]+\]\s*')
+
+
+def strip_timestamp_prefix(log_message: str) -> str:
+    """Remove a leading "[timestamp] " prefix from a device log line."""
+    return _TIMESTAMP_PREFIX_RE.sub('', log_message, count=1)
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
 
 
 class LLMProvider(str, Enum):
@@ -22,12 +37,25 @@ class LLMClient:
     Client for interacting with local LLM providers.
     """
     
+    # Fenced ```json block, used when the cheaper JSON extraction paths fail
+    _FENCED_JSON_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+    # Threat-level words for non-JSON responses; one group per level
+    _LEVEL_RE = re.compile(
+        r"\b(?:(?P<high>critical|high|severe)|(?P<medium>medium|moderate)"
+        r"|(?P<low>low|minor)|(?P<none>none|normal|safe))\b",
+        re.IGNORECASE
+    )
+    # (level, severity) fallbacks, most severe first
+    _LEVEL_SEVERITIES = (("high", 0.8), ("medium", 0.5), ("low", 0.3), ("none", 0.0))
+    
     def __init__(self,
                  provider: str = "ollama",
                  model: str = "phi3:mini",
                  base_url: str = "http://localhost:11434",
                  temperature: float = 0.3,
-                 max_tokens: int = 500):
+                 max_tokens: int = 500,
+                 max_concurrency: int = 4,
+                 cache_size: int = 4096):
         """
         Initialize LLM client.
         
@@ -37,16 +65,31 @@ class LLMClient:
             base_url: Base URL for API
             temperature: Sampling temperature
             max_tokens: Maximum tokens to generate
+            max_concurrency: Maximum concurrent requests for batch analysis
+            cache_size: Number of analyses kept in the LRU response cache
         """
         self.provider = LLMProvider(provider.lower())
         self.model = model
         self.base_url = base_url.rstrip('/')
         self.temperature = temperature
         self.max_tokens = max_tokens
+        # Shared keep-alive client. The connection limit caps in-flight requests;
+        # extra requests wait for a free connection (no pool timeout).
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, pool=None),
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        )
+        # LRU cache of parsed analyses, keyed on (normalized message, device)
+        self._cache: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_hits = 0
+        self._cache_misses = 0
+        # Misses still waiting on the LLM, so identical concurrent requests share one call
+        self._pending: Dict[Tuple[str, str], asyncio.Task] = {}
         
         logger.info(f"Initialized LLM client: {self.provider.value} with model {self.model}")
     
-    def analyze_log(self, log_message: str, device_id: str) -> Dict:
+    async def analyze_log(self, log_message: str, device_id: str) -> Dict:
         """
         Analyze a log message and return threat assessment.
         
@@ -57,11 +100,10 @@ class LLMClient:
         Returns:
             Dictionary with analysis results
         """
-        prompt = self._build_analysis_prompt(log_message, device_id)
+        normalized = strip_timestamp_prefix(log_message)
         
         try:
-            response = self._generate(prompt)
-            return self._parse_response(response)
+            return dict(await self._analyze_cached(normalized, device_id))
         except Exception as e:
             logger.error(f"Error analyzing log: {e}")
             return {
@@ -71,6 +113,74 @@ class LLMClient:
                 "recommendation": "Review log manually"
             }
     
+    async def _analyze_cached(self, log_message: str, device_id: str) -> tuple:
+        """
+        Return the cached analysis, querying the LLM on a miss.
+        
+        A request identical to one already in flight waits for that request's
+        result (counted as a hit) instead of querying the LLM again.
+        """
+        key = (log_message, device_id)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self._cache_hits += 1
+            return cached
+        
+        task = self._pending.get(key)
+        if task is not None:
+            self._cache_hits += 1
+        else:
+            self._cache_misses += 1
+            task = self._pending[key] = asyncio.ensure_future(
+                self._fetch(key, log_message, device_id)
+            )
+        # Shielded so one cancelled caller doesn't cancel the shared request
+        return await asyncio.shield(task)
+    
+    async def _fetch(self, key: Tuple[str, str], log_message: str, device_id: str) -> tuple:
+        """Query the LLM for a cache miss and cache the result if it was JSON."""
+        try:
+            result, is_json = await self._analyze_uncached(log_message, device_id)
+        finally:
+            # Errors are not cached either: the next request retries
+            del self._pending[key]
+        # Text-fallback analyses are not cached, so a malformed generation is
+        # retried the next time the line is seen
+        if is_json:
+            self._cache[key] = result
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return result
+    
+    async def _analyze_uncached(self, log_message: str, device_id: str) -> Tuple[tuple, bool]:
+        """
+        Query the LLM.
+        
+        Returns the parsed analysis frozen into a hashable tuple, and whether
+        it was parsed from JSON.
+        """
+        prompt = self._build_analysis_prompt(log_message, device_id)
+        response = await self._generate(prompt)
+        analysis, is_json = self._parse_response(response)
+        return tuple(analysis.items()), is_json
+    
+    def cache_info(self) -> CacheInfo:
+        """Return hit/miss statistics for the response cache."""
+        return CacheInfo(self._cache_hits, self._cache_misses, self._cache_size, len(self._cache))
+    
+    async def analyze_batch(self, logs: List[Tuple[str, str]]) -> List[Dict]:
+        """
+        Analyze several log messages concurrently.
+        
+        Args:
+            logs: List of (log_message, device_id) tuples
+            
+        Returns:
+            Analysis results, in the same order as the input
+        """
+        return list(await asyncio.gather(*(self.analyze_log(*log) for log in logs)))
+    
     def _build_analysis_prompt(self, log_message: str, device_id: str) -> str:
         """Build prompt for log analysis."""
         return f"""You are a cybersecurity expert analyzing IoT device logs. Analyze the following log message and determine if it indicates a security threat.
@@ -83,6 +193,7 @@ Provide your analysis in JSON format with the following fields:
 - severity: float between 0.0 and 1.0
 - explanation: brief explanation of what the log indicates
 - recommendation: actionable security recommendation
+- threat_type: "unauthorized_access", "brute_force", "network_anomaly", "configuration_change", "data_exfiltration", "malware", "denial_of_service", or "unknown"
 
 Focus on:
 - Unauthorized access attempts
@@ -93,16 +204,16 @@ Focus on:
 
 JSON Response:"""
     
-    def _generate(self, prompt: str) -> str:
+    async def _generate(self, prompt: str) -> str:
         """Generate response from LLM."""
         if self.provider == LLMProvider.OLLAMA:
-            return self._generate_ollama(prompt)
+            return await self._generate_ollama(prompt)
         elif self.provider == LLMProvider.LM_STUDIO:
-            return self._generate_lm_studio(prompt)
+            return await self._generate_lm_studio(prompt)
         else:
             raise ValueError(f"Unsupported provider: {self.provider}")
     
-    def _generate_ollama(self, prompt: str) -> str:
+    async def _generate_ollama(self, prompt: str) -> str:
         """Generate using Ollama API."""
         url = f"{self.base_url}/api/generate"
         
@@ -116,13 +227,13 @@ JSON Response:"""
             }
         }
         
-        response = requests.post(url, json=payload, timeout=30)
+        response = await self._client.post(url, json=payload)
         response.raise_for_status()
         
         result = response.json()
         return result.get("response", "")
     
-    def _generate_lm_studio(self, prompt: str) -> str:
+    async def _generate_lm_studio(self, prompt: str) -> str:
         """Generate using LM Studio API (OpenAI-compatible)."""
         url = f"{self.base_url}/v1/chat/completions"
         
@@ -135,32 +246,22 @@ JSON Response:"""
             "max_tokens": self.max_tokens
         }
         
-        response = requests.post(url, json=payload, timeout=30)
+        response = await self._client.post(url, json=payload)
         response.raise_for_status()
         
         result = response.json()
         return result["choices"][0]["message"]["content"]
     
-    def _parse_response(self, response: str) -> Dict:
-        """Parse LLM response into structured format."""
+    def _parse_response(self, response: str) -> Tuple[Dict, bool]:
+        """
+        Parse LLM response into structured format.
+        
+        Returns the analysis and whether it came from JSON (False when the
+        text fallback was used).
+        """
         # Try to extract JSON from response
         try:
-            # Look for JSON block
-            if "```json" in response:
-                json_start = response.find("```json") + 7
-                json_end = response.find("```", json_start)
-                json_str = response[json_start:json_end].strip()
-            elif "```" in response:
-                json_start = response.find("```") + 3
-                json_end = response.find("```", json_start)
-                json_str = response[json_start:json_end].strip()
-            else:
-                # Try to find JSON object
-                json_start = response.find("{")
-                json_end = response.rfind("}") + 1
-                json_str = response[json_start:json_end]
-            
-            parsed = json.loads(json_str)
+            parsed = self._load_json(response)
             
             # Validate and normalize
             threat_level = parsed.get("threat_level", "unknown").lower()
@@ -168,51 +269,81 @@ JSON Response:"""
             explanation = parsed.get("explanation", "No explanation provided")
             recommendation = parsed.get("recommendation", "No recommendation")
             
-            return {
+            result = {
                 "threat_level": threat_level,
                 "severity": max(0.0, min(1.0, severity)),
                 "explanation": explanation,
                 "recommendation": recommendation
             }
+            # Optional structured hint; the classifier validates it
+            threat_type = parsed.get("threat_type")
+            if isinstance(threat_type, str):
+                result["threat_type"] = threat_type.lower()
+            return result, True
         except Exception as e:
             logger.warning(f"Failed to parse JSON response: {e}")
-            # Fallback: extract information from text
+            # Fallback: extract information from text in a single regex pass
             threat_level = "unknown"
             severity = 0.5
             
-            if any(word in response.lower() for word in ["critical", "high", "severe"]):
-                threat_level = "high"
-                severity = 0.8
-            elif any(word in response.lower() for word in ["medium", "moderate"]):
-                threat_level = "medium"
-                severity = 0.5
-            elif any(word in response.lower() for word in ["low", "minor"]):
-                threat_level = "low"
-                severity = 0.3
-            elif any(word in response.lower() for word in ["none", "normal", "safe"]):
-                threat_level = "none"
-                severity = 0.0
+            found = {m.lastgroup for m in self._LEVEL_RE.finditer(response)}
+            for level, level_severity in self._LEVEL_SEVERITIES:
+                if level in found:
+                    threat_level = level
+                    severity = level_severity
+                    break
             
             return {
                 "threat_level": threat_level,
                 "severity": severity,
                 "explanation": response[:500],  # First 500 chars
                 "recommendation": "Review log manually"
-            }
+            }, False
+    
+    def _load_json(self, response: str):
+        """Decode the JSON object in an LLM response, trying the cheapest cases first."""
+        # Happy path: the model answered with a bare JSON object (not, e.g., an
+        # array wrapping one, which the brace slice below still recovers)
+        try:
+            parsed = orjson.loads(response)
+        except orjson.JSONDecodeError:
+            pass
+        else:
+            if isinstance(parsed, dict):
+                return parsed
+        
+        # JSON object surrounded by prose
+        json_start = response.find("{")
+        json_end = response.rfind("}") + 1
+        if 0 <= json_start < json_end:
+            try:
+                return orjson.loads(response[json_start:json_end])
+            except orjson.JSONDecodeError:
+                pass
+        
+        # Fenced code block, possibly followed by more text containing braces
+        match = self._FENCED_JSON_RE.search(response)
+        if match is None:
+            raise ValueError("No JSON object found in response")
+        return orjson.loads(match.group(1))
     
-    def test_connection(self) -> bool:
+    async def test_connection(self) -> bool:
         """Test connection to LLM provider."""
         try:
             if self.provider == LLMProvider.OLLAMA:
-                response = requests.get(f"{self.base_url}/api/tags", timeout=5)
+                response = await self._client.get(f"{self.base_url}/api/tags", timeout=5)
                 return response.status_code == 200
             elif self.provider == LLMProvider.LM_STUDIO:
-                response = requests.get(f"{self.base_url}/v1/models", timeout=5)
+                response = await self._client.get(f"{self.base_url}/v1/models", timeout=5)
                 return response.status_code == 200
             return False
         except Exception as e:
             logger.error(f"Connection test failed: {e}")
             return False
+    
+    async def aclose(self):
+        """Release pooled HTTP connections."""
+        await self._client.aclose()
 
 
 
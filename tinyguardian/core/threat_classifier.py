@@ -3,11 +3,37 @@ Threat Classifier
 Classifies security events based on LLM analysis and heuristics.
 """
 
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from datetime import datetime, timedelta
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from collections import defaultdict, deque
 from enum import Enum
 from loguru import logger
+import re
+import sys
+
+# Optional multi-keyword matchers, fastest first: Hyperscan (SIMD DFA), then
+# pyahocorasick; without either, keywords are matched with substring scans
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None  # type: ignore[assignment]
+
+try:
+    import ahocorasick  # type: ignore[import-not-found]
+except ImportError:
+    ahocorasick = None  # type: ignore[assignment]
+
+
+# IPv4 address (ASCII digits, octets 0-255), or "user=alice" / "username: bob"
+# / "login=carol". The user name is captured in a lookahead so an IP used as
+# the value is still seen.
+_OCTET = r'(?:25[0-5]|2[0-4][0-9]|[01]?[0-9]?[0-9])'
+_META_RE = re.compile(
+    r'(?P<ip>\b(?:' + _OCTET + r'\.){3}' + _OCTET + r'\b)'
+    r'|(?:user(?:name)?|login)[=:]\s*(?=(?P<user>\w+))',
+    re.IGNORECASE
+)
 
 
 class ThreatType(str, Enum):
@@ -22,7 +48,11 @@ class ThreatType(str, Enum):
     UNKNOWN = "unknown"
 
 
-@dataclass
+# __slots__ dataclasses (no per-instance __dict__) need Python 3.10+
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_SLOTS)
 class SecurityEvent:
     """Represents a security event."""
     event_id: str
@@ -36,6 +66,110 @@ class SecurityEvent:
     recommendation: str
     source_ip: Optional[str] = None
     user: Optional[str] = None
+    # timestamp as epoch seconds, for cheap float comparisons on the hot path
+    epoch: Optional[float] = field(default=None, repr=False, compare=False)
+    # String forms for serialization, computed once at creation
+    threat_type_str: str = field(init=False, repr=False, compare=False)
+    timestamp_iso: str = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        if self.epoch is None:
+            self.epoch = self.timestamp.timestamp()
+        self.threat_type_str = self.threat_type.value
+        self.timestamp_iso = self.timestamp.isoformat()
+    
+    def to_dict(self) -> Dict:
+        """Serialize to a JSON-ready dict (built once at ingestion)."""
+        return {
+            "event_id": self.event_id,
+            "device_id": self.device_id,
+            "timestamp": self.timestamp_iso,
+            "threat_level": self.threat_level,
+            "severity": self.severity,
+            "threat_type": self.threat_type_str,
+            "explanation": self.explanation,
+            "recommendation": self.recommendation,
+            "source_ip": self.source_ip,
+            "user": self.user
+        }
+
+
+# Earlier same-type events from a device within the window that mark a pattern
+_PATTERN_MIN_EVENTS = 3
+
+# Keyword families (bit flags) matched as substrings of the lower-cased
+# log message + LLM explanation
+_KW_FAILED_LOGIN = 1 << 0
+_KW_BRUTE = 1 << 1
+_KW_UNAUTHORIZED = 1 << 2
+_KW_NETWORK = 1 << 3
+_KW_CONFIG = 1 << 4
+_KW_EXFILTRATION = 1 << 5
+_KW_MALWARE = 1 << 6
+_KW_DOS = 1 << 7
+
+_THREAT_KEYWORDS = (
+    (_KW_FAILED_LOGIN, ("failed login", "authentication failed", "invalid password")),
+    (_KW_BRUTE, ("multiple", "repeated", "brute")),
+    (_KW_UNAUTHORIZED, ("unauthorized", "access denied", "permission denied")),
+    (_KW_NETWORK, ("network", "connection", "socket", "port scan")),
+    (_KW_CONFIG, ("config", "setting", "configuration changed")),
+    (_KW_EXFILTRATION, ("data", "export", "download", "exfiltrat")),
+    (_KW_MALWARE, ("malware", "virus", "trojan", "ransomware")),
+    (_KW_DOS, ("dos", "ddos", "denial", "overload")),
+)
+
+# Families checked after failed-login/brute-force, highest precedence first
+_THREAT_PRECEDENCE = (
+    (_KW_UNAUTHORIZED, ThreatType.UNAUTHORIZED_ACCESS),
+    (_KW_NETWORK, ThreatType.NETWORK_ANOMALY),
+    (_KW_CONFIG, ThreatType.CONFIGURATION_CHANGE),
+    (_KW_EXFILTRATION, ThreatType.DATA_EXFILTRATION),
+    (_KW_MALWARE, ThreatType.MALWARE),
+    (_KW_DOS, ThreatType.DENIAL_OF_SERVICE),
+)
+
+
+def _build_keyword_automaton():
+    """Build an Aho-Corasick automaton mapping each keyword to its family flags."""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for flag, keywords in _THREAT_KEYWORDS:
+        for keyword in keywords:
+            automaton.add_word(keyword, automaton.get(keyword, 0) | flag)
+    automaton.make_automaton()
+    return automaton
+
+
+def _build_keyword_database():
+    """Compile a Hyperscan database whose match IDs are the keyword family flags."""
+    if hyperscan is None:
+        return None
+    expressions = []
+    ids = []
+    for flag, keywords in _THREAT_KEYWORDS:
+        for keyword in keywords:
+            expressions.append(re.escape(keyword).encode())
+            ids.append(flag)
+    database = hyperscan.Database()
+    database.compile(
+        expressions=expressions,
+        ids=ids,
+        elements=len(expressions),
+        flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(expressions)
+    )
+    return database
+
+
+def _intern(value):
+    """Intern str values; anything else (None, malformed LLM output) passes through."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _on_keyword_match(match_id, start, end, flags, context):
+    """Hyperscan match callback: OR the family flag into context[0]."""
+    context[0] |= match_id
 
 
 class ThreatClassifier:
@@ -43,16 +177,32 @@ class ThreatClassifier:
     Classifies security events and determines threat types.
     """
     
-    def __init__(self, severity_threshold: float = 0.7):
+    def __init__(self,
+                 severity_threshold: float = 0.7,
+                 max_recent_events: int = 64,
+                 noise_threshold: float = 0.2):
         """
         Initialize threat classifier.
         
         Args:
             severity_threshold: Minimum severity to trigger alert
+            max_recent_events: Per-device cap on recent events kept in memory
+            noise_threshold: Unknown-type events below this severity are not
+                tracked for pattern escalation or kept in recent_events
         """
         self.severity_threshold = severity_threshold
-        self.recent_events: Dict[str, list] = {}  # device_id -> events
+        self.noise_threshold = noise_threshold
+        self.max_recent_events = max_recent_events
+        self.recent_events: Dict[str, deque] = {}  # device_id -> events, oldest first
         self.event_window = timedelta(minutes=5)
+        self._window_s = self.event_window.total_seconds()
+        # (device_id, threat_type) -> latest epoch timestamps, oldest first. Only
+        # the newest _PATTERN_MIN_EVENTS can decide a pattern, so keep just those.
+        self._pattern_buckets: Dict[Tuple[str, ThreatType], deque] = defaultdict(
+            lambda: deque(maxlen=_PATTERN_MIN_EVENTS)
+        )
+        self._hs_db = _build_keyword_database()
+        self._kw_automaton = _build_keyword_automaton() if self._hs_db is None else None
         
         logger.info(f"Threat classifier initialized (threshold: {severity_threshold})")
     
@@ -75,121 +225,149 @@ class ThreatClassifier:
         """
         if timestamp is None:
             timestamp = datetime.now()
+        ts = timestamp.timestamp()
+        # Start of the pattern window, shared by bucket and history pruning
+        cutoff = ts - self._window_s
+        # Device IDs, levels, IPs and users repeat across events: intern them so
+        # retained events share one copy and bucket-key lookups compare by identity
+        device_id = _intern(device_id)
         
         # Determine threat type from analysis
         threat_type = self._determine_threat_type(log_message, llm_analysis)
         
         # Extract additional metadata
-        source_ip = self._extract_ip(log_message)
-        user = self._extract_user(log_message)
+        source_ip, user = self._extract_metadata(log_message)
+        source_ip = _intern(source_ip)
+        user = _intern(user)
         
-        # Check for pattern-based escalation
+        # Benign noise skips pattern tracking and history entirely
         severity = llm_analysis.get("severity", 0.0)
-        if self._check_pattern(device_id, threat_type, timestamp):
+        is_noise = threat_type is ThreatType.UNKNOWN and severity < self.noise_threshold
+        
+        # Check for pattern-based escalation
+        if not is_noise and self._register_and_check(device_id, threat_type, ts, cutoff):
             severity = min(1.0, severity + 0.2)  # Escalate
         
         event = SecurityEvent(
-            event_id=f"evt_{timestamp.timestamp():.0f}_{device_id}",
+            event_id=f"evt_{round(ts)}_{device_id}",
             device_id=device_id,
             timestamp=timestamp,
             log_message=log_message,
-            threat_level=llm_analysis.get("threat_level", "unknown"),
+            threat_level=_intern(llm_analysis.get("threat_level", "unknown")),
             severity=severity,
             threat_type=threat_type,
             explanation=llm_analysis.get("explanation", ""),
             recommendation=llm_analysis.get("recommendation", ""),
             source_ip=source_ip,
-            user=user
+            user=user,
+            epoch=ts
         )
+        if is_noise:
+            return event
         
-        # Store in recent events
-        if device_id not in self.recent_events:
-            self.recent_events[device_id] = []
-        self.recent_events[device_id].append(event)
+        # Store in recent events (bounded; pattern detection uses the buckets)
+        events = self.recent_events.get(device_id)
+        if events is None:
+            events = self.recent_events[device_id] = deque(maxlen=self.max_recent_events)
+        events.append(event)
         
         # Clean old events
-        self._clean_old_events(device_id, timestamp)
+        self._clean_old_events(device_id, cutoff)
         
         return event
     
     def _determine_threat_type(self, log_message: str, llm_analysis: Dict) -> ThreatType:
-        """Determine threat type from log and analysis."""
-        message_lower = log_message.lower()
-        explanation_lower = llm_analysis.get("explanation", "").lower()
-        combined = f"{message_lower} {explanation_lower}"
-        
-        # Pattern matching
-        if any(term in combined for term in ["failed login", "authentication failed", "invalid password"]):
-            if any(term in combined for term in ["multiple", "repeated", "brute"]):
-                return ThreatType.BRUTE_FORCE
-            return ThreatType.UNAUTHORIZED_ACCESS
-        
-        if any(term in combined for term in ["unauthorized", "access denied", "permission denied"]):
-            return ThreatType.UNAUTHORIZED_ACCESS
+        """
+        Determine threat type from log and analysis.
         
-        if any(term in combined for term in ["network", "connection", "socket", "port scan"]):
-            return ThreatType.NETWORK_ANOMALY
+        If the LLM analysis carries a "threat_type" naming a known ThreatType
+        other than "unknown", it is trusted and keyword matching is skipped.
+        """
+        hint = llm_analysis.get("threat_type")
+        if hint:
+            try:
+                threat_type = ThreatType(hint)
+            except ValueError:
+                threat_type = ThreatType.UNKNOWN
+            if threat_type is not ThreatType.UNKNOWN:
+                return threat_type
         
-        if any(term in combined for term in ["config", "setting", "configuration changed"]):
-            return ThreatType.CONFIGURATION_CHANGE
+        # Join first, then lower-case the combined buffer in a single pass
+        combined = f"{log_message} {llm_analysis.get('explanation', '')}".lower()
         
-        if any(term in combined for term in ["data", "export", "download", "exfiltrat"]):
-            return ThreatType.DATA_EXFILTRATION
+        # Single pass over the text, then apply precedence to the matched families
+        matched = self._match_keywords(combined)
+        if not matched:
+            return ThreatType.UNKNOWN
         
-        if any(term in combined for term in ["malware", "virus", "trojan", "ransomware"]):
-            return ThreatType.MALWARE
+        if matched & _KW_FAILED_LOGIN:
+            if matched & _KW_BRUTE:
+                return ThreatType.BRUTE_FORCE
+            return ThreatType.UNAUTHORIZED_ACCESS
         
-        if any(term in combined for term in ["dos", "ddos", "denial", "overload"]):
-            return ThreatType.DENIAL_OF_SERVICE
+        for flag, threat_type in _THREAT_PRECEDENCE:
+            if matched & flag:
+                return threat_type
         
         return ThreatType.UNKNOWN
     
-    def _extract_ip(self, log_message: str) -> Optional[str]:
-        """Extract IP address from log message."""
-        import re
-        ip_pattern = r'\b(?:\d{1,3}\.){3}\d{1,3}\b'
-        matches = re.findall(ip_pattern, log_message)
-        return matches[0] if matches else None
+    def _match_keywords(self, text: str) -> int:
+        """Return the bitmask of keyword families found in text."""
+        matched = 0
+        if self._hs_db is not None:
+            found = [0]
+            self._hs_db.scan(text.encode(), match_event_handler=_on_keyword_match, context=found)
+            matched = found[0]
+        elif self._kw_automaton is not None:
+            for _, flags in self._kw_automaton.iter(text):
+                matched |= flags
+        else:
+            for flag, keywords in _THREAT_KEYWORDS:
+                if any(keyword in text for keyword in keywords):
+                    matched |= flag
+        return matched
     
-    def _extract_user(self, log_message: str) -> Optional[str]:
-        """Extract username from log message."""
-        import re
-        # Common patterns: user=, username=, user:, etc.
-        patterns = [
-            r'user[=:]\s*(\w+)',
-            r'username[=:]\s*(\w+)',
-            r'login[=:]\s*(\w+)',
-        ]
-        for pattern in patterns:
-            match = re.search(pattern, log_message, re.IGNORECASE)
-            if match:
-                return match.group(1)
-        return None
+    def _extract_metadata(self, log_message: str) -> Tuple[Optional[str], Optional[str]]:
+        """Extract the first IP address and username from a log message in one scan."""
+        source_ip = None
+        user = None
+        for match in _META_RE.finditer(log_message):
+            if match.lastgroup == "ip":
+                source_ip = source_ip or match.group("ip")
+            else:
+                user = user or match.group("user")
+            if source_ip and user:
+                break
+        return source_ip, user
     
-    def _check_pattern(self, device_id: str, threat_type: ThreatType, timestamp: datetime) -> bool:
-        """Check if event is part of a pattern (e.g., repeated attacks)."""
-        if device_id not in self.recent_events:
-            return False
-        
-        recent = [
-            e for e in self.recent_events[device_id]
-            if e.timestamp >= timestamp - self.event_window
-            and e.threat_type == threat_type
-        ]
-        
-        # If 3+ similar events in window, it's a pattern
-        return len(recent) >= 3
+    def _register_and_check(self, device_id: str, threat_type: ThreatType,
+                            ts: float, cutoff: float) -> bool:
+        """
+        Record an event and check if it is part of a pattern (e.g., repeated attacks).
+        
+        Returns True if 3+ earlier events of the same type from this device fall
+        within the window (at or after cutoff).
+        """
+        bucket = self._pattern_buckets[(device_id, threat_type)]
+        while bucket and bucket[0] < cutoff:
+            bucket.popleft()
+        is_pattern = len(bucket) >= _PATTERN_MIN_EVENTS
+        bucket.append(ts)
+        return is_pattern
     
-    def _clean_old_events(self, device_id: str, current_time: datetime):
-        """Remove events outside the time window."""
-        if device_id not in self.recent_events:
+    def _clean_old_events(self, device_id: str, cutoff: float):
+        """
+        Remove events older than cutoff (epoch seconds).
+        
+        Assumes events for a device arrive in timestamp order (they are stamped
+        on receipt), so expired events are always at the front of the deque.
+        """
+        events = self.recent_events.get(device_id)
+        if not events:
             return
         
-        cutoff = current_time - self.event_window
-        self.recent_events[device_id] = [
-            e for e in self.recent_events[device_id]
-            if e.timestamp >= cutoff
-        ]
+        while events and events[0].epoch < cutoff:
+            events.popleft()
     
     def is_alert(self, event: SecurityEvent) -> bool:
         """Determine if event should trigger an alert."""